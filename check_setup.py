@@ -19,7 +19,7 @@ def check_python():
     return True
 
 def check_packages():
-    required = ['numpy', 'pandas', 'nibabel', 'nilearn', 'scikit-learn', 'scipy', 'joblib', 'PyYAML', 'matplotlib', 'seaborn', 'tqdm']
+    required = ['numpy', 'pandas', 'nibabel', 'nilearn', 'scipy', 'joblib', 'PyYAML', 'pyarrow', 'matplotlib', 'seaborn', 'tqdm']
     missing = []
     for pkg in required:
         try:
@@ -37,14 +37,14 @@ def check_config():
     if yaml is None:
         print("  PyYAML not installed; skip config check")
         return True
+    from scripts.utils import load_yaml_cached
     for name in ['config/pipeline_config.yaml', 'config/roi_config.yaml', 'config/buffer_zone_config.yaml']:
-        if not os.path.exists(name):
-            print(f"  {name} missing")
-            return False
         try:
-            with open(name) as f:
-                yaml.safe_load(f)
+            load_yaml_cached(name)
             print(f"  {name} OK")
+        except FileNotFoundError:
+            print(f"  {name} missing")
+            return False
         except Exception as e:
             print(f"  {name} invalid: {e}")
             return False
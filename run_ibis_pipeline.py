@@ -15,14 +15,9 @@ _ROOT = os.path.dirname(os.path.abspath(__file__))
 if _ROOT not in sys.path:
     sys.path.insert(0, _ROOT)
 
-from scripts.roi_extraction import ROIExtractor
-from scripts.buffer_zone import BufferZoneAnalyzer
-from scripts.variable_extraction import VariableExtractor
-from scripts.data_consolidation import DataConsolidator
-from scripts.utils import setup_logging, validate_config
+from scripts.utils import setup_logging, validate_config, load_yaml_cached
 
 import argparse
-import yaml
 import logging
 from datetime import datetime
 
@@ -41,8 +36,7 @@ class IBISPipeline:
         self.data_consolidator = None
 
     def _load_config(self):
-        with open(self.config_path, 'r') as f:
-            return yaml.safe_load(f)
+        return load_yaml_cached(self.config_path)
 
     def _setup_logging(self):
         log_config = self.config.get('logging', {})
@@ -65,6 +59,12 @@ class IBISPipeline:
         validate_config(self.config)
 
     def initialize_components(self):
+        # Imported here so --validate-only does not load the imaging stack
+        from scripts.roi_extraction import ROIExtractor
+        from scripts.buffer_zone import BufferZoneAnalyzer
+        from scripts.variable_extraction import VariableExtractor
+        from scripts.data_consolidation import DataConsolidator
+
         self.roi_extractor = ROIExtractor(self.config, self.logger)
         self.buffer_zone_analyzer = BufferZoneAnalyzer(self.config, self.logger)
         self.variable_extractor = VariableExtractor(self.config, self.logger)
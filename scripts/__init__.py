@@ -4,10 +4,8 @@ IBIS (Integrated Brain Information System) — Scripts package.
 
 __version__ = "1.0.0"
 
-from .roi_extraction import ROIExtractor
-from .buffer_zone import BufferZoneAnalyzer
-from .variable_extraction import VariableExtractor
-from .data_consolidation import DataConsolidator
+import importlib
+
 from .utils import (
     setup_logging,
     validate_config,
@@ -33,3 +31,20 @@ __all__ = [
     "create_progress_logger",
     "log_memory_usage",
 ]
+
+# Pipeline components pull in nilearn/nibabel/scipy, so they are imported on
+# first access (PEP 562) rather than with the package.
+_LAZY_COMPONENTS = {
+    "ROIExtractor": ".roi_extraction",
+    "BufferZoneAnalyzer": ".buffer_zone",
+    "VariableExtractor": ".variable_extraction",
+    "DataConsolidator": ".data_consolidation",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_COMPONENTS:
+        value = getattr(importlib.import_module(_LAZY_COMPONENTS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
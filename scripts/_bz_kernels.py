@@ -0,0 +1,48 @@
+"""
+Optional Numba kernels for buffer zone statistics.
+
+``sphere_stats`` is None when numba is not installed; callers fall back to
+the NumPy reductions in ``buffer_zone._sphere_stats``.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+sphere_stats = None
+
+if njit is not None:
+    # nogil rather than parallel=True: process_coordinate_files already runs
+    # files on joblib threads, and numba's default threading layer does not
+    # support concurrent launches of parallel kernels.
+    @njit(nogil=True, cache=True)
+    def sphere_stats(X, indptr, indices, rows, mean_out, std_out, max_out, min_out):
+        """Fill the output arrays for each sphere row in one pass over its voxel values."""
+        n_scans = X.shape[0]
+        for r in range(rows.shape[0]):
+            row = rows[r]
+            total = 0.0
+            total_sq = 0.0
+            hi = -np.inf
+            lo = np.inf
+            for p in range(indptr[row], indptr[row + 1]):
+                col = indices[p]
+                for t in range(n_scans):
+                    v = X[t, col]
+                    total += v
+                    total_sq += v * v
+                    if v > hi:
+                        hi = v
+                    if v < lo:
+                        lo = v
+            n = (indptr[row + 1] - indptr[row]) * n_scans
+            mean = total / n
+            mean_out[r] = mean
+            std_out[r] = np.sqrt(max(total_sq / n - mean * mean, 0.0))
+            if np.isnan(total):
+                hi = lo = np.nan
+            max_out[r] = hi
+            min_out[r] = lo
@@ -3,21 +3,60 @@ Buffer Zone Analysis Module
 """
 
 import os
+import re
 import numpy as np
 import pandas as pd
 import warnings
-from sklearn import neighbors
-from scipy import sparse
+from scipy.spatial import cKDTree
 from nilearn import image, masking
 from nilearn.masking import apply_mask
 from nilearn._utils.niimg_conversions import check_niimg_3d
 import logging
+from joblib import Parallel, delayed
 
+from . import _bz_kernels
 from .utils import (
-    get_file_list, extract_subject_id, create_progress_logger, log_memory_usage
+    get_file_list, extract_subject_id, create_progress_logger, log_memory_usage,
+    load_yaml_cached, read_csv_fast
 )
 
 
+def _ball_lists_to_csr(idx_lists):
+    """Convert per-seed index lists from query_ball_point into CSR (indptr, indices) arrays."""
+    counts = np.fromiter((len(idx) for idx in idx_lists), dtype=np.intp, count=len(idx_lists))
+    indptr = np.zeros(len(idx_lists) + 1, dtype=np.intp)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.concatenate(idx_lists).astype(np.intp, copy=False) if indptr[-1] else np.empty(0, dtype=np.intp)
+    return indptr, indices
+
+
+def _sphere_stats(X, indptr, indices):
+    """Per-sphere mean/std/max/min from a CSR seed-to-voxel graph; empty spheres are dropped."""
+    counts = np.diff(indptr)
+    rows = np.flatnonzero(counts).astype(np.int32)
+    counts = counts[rows].astype(np.int32)
+    # Statistics are accumulated in float64 and stored as float32 columns
+    mean, std, max_val, min_val = (np.empty(len(rows), dtype=np.float32) for _ in range(4))
+    if X is None:
+        for out in (mean, std, max_val, min_val):
+            out.fill(np.nan)
+        return rows, counts, mean, std, max_val, min_val
+    if _bz_kernels.sphere_stats is not None:
+        _bz_kernels.sphere_stats(X, indptr, indices, rows, mean, std, max_val, min_val)
+        return rows, counts, mean, std, max_val, min_val
+    starts = indptr[:-1][rows]
+    vals = X[:, indices]
+    n = counts * X.shape[0]
+    sums = np.add.reduceat(vals, starts, axis=1, dtype=np.float64).sum(axis=0)
+    sqsums = np.add.reduceat(np.square(vals, dtype=np.float64), starts, axis=1).sum(axis=0)
+    mean64 = sums / n
+    np.copyto(mean, mean64, casting='same_kind')
+    np.sqrt(np.maximum(sqsums / n - mean64 ** 2, 0.0), out=std, casting='same_kind')
+    np.maximum.reduceat(vals, starts, axis=1).max(axis=0, out=max_val)
+    np.minimum.reduceat(vals, starts, axis=1).min(axis=0, out=min_val)
+    return rows, counts, mean, std, max_val, min_val
+
+
 class BufferZoneAnalyzer:
     """Buffer zone analysis using spherical maskers."""
 
@@ -33,67 +72,76 @@ class BufferZoneAnalyzer:
         self.bz_settings = config.get('buffer_zone', {})
         self.default_radius = self.bz_settings.get('default_radius', 5.0)
         self.allow_overlap = self.bz_settings.get('allow_overlap', False)
+        self.n_jobs = config.get('processing', {}).get('n_jobs', -1)
+        self._tree_cache = {}
+        self._subject_re = re.compile(r'(\d{4})')
 
     def _load_bz_config(self):
         path = os.path.join('config', 'buffer_zone_config.yaml')
         if os.path.exists(path):
             try:
-                import yaml
-                with open(path, 'r') as f:
-                    return yaml.safe_load(f)
+                return load_yaml_cached(path)
             except Exception as e:
                 self.logger.warning(f"Could not load buffer zone config: {e}")
         return {}
 
-    def _apply_mask_and_get_affinity(self, seeds, niimg, radius, allow_overlap, mask_img=None):
+    def _prepare_mask(self, niimg, mask_img=None):
         if niimg is None:
             mask, affine = masking._load_mask_img(mask_img)
-            mask_coords = np.asarray(np.nonzero(mask)).T.tolist()
+            mask_coords = np.argwhere(mask)
             X = None
         elif mask_img is not None:
             affine = niimg.affine
             mask_img = check_niimg_3d(mask_img)
             mask_img = image.resample_img(mask_img, target_affine=affine, target_shape=niimg.shape[:3], interpolation='nearest')
             mask, _ = masking._load_mask_img(mask_img)
-            mask_coords = list(zip(*np.where(mask != 0)))
+            mask_coords = np.argwhere(mask != 0)
             masked = apply_mask(niimg, mask_img, dtype='f')
             X = masked.reshape(1, -1) if masked.ndim == 1 else masked
         else:
-            raise ValueError("Either niimg or mask_img must be provided")
-        mask_coords = np.asarray(list(zip(*mask_coords)))
-        mask_coords = np.asarray(image.resampling.coord_transform(mask_coords[0], mask_coords[1], mask_coords[2], affine)).T
-        clf = neighbors.NearestNeighbors(radius=radius, n_jobs=-1)
-        clf.fit(mask_coords)
-        A = clf.radius_neighbors_graph(seeds)
-        return X, A
-
-    def extract_buffer_zone_data(self, coordinates_file, image_file, radius=None):
+            affine = niimg.affine
+            data = niimg.get_fdata(dtype=np.float32)
+            if np.isnan(data).any():
+                warnings.warn("Image contains NaN values which will be converted to zeroes.")
+                data = np.nan_to_num(data, copy=False)
+            X = data.reshape(int(np.prod(niimg.shape[:3])), -1).T
+            mask_coords = np.indices(niimg.shape[:3]).reshape(3, -1).T
+        # Voxel -> world (mm) as a single matmul with the affine
+        mask_coords = mask_coords @ affine[:3, :3].T + affine[:3, 3]
+        return mask_coords, X
+
+    def _build_tree(self, mask_coords):
+        return cKDTree(mask_coords, leafsize=32)
+
+    def _get_image_tree(self, image_file, img=None):
+        """Masked data and KD-tree of voxel world coordinates, built once per image."""
+        if image_file not in self._tree_cache:
+            if img is None:
+                img = image.load_img(image_file)
+            mask_coords, X = self._prepare_mask(img)
+            self._tree_cache[image_file] = (X, self._build_tree(mask_coords))
+        return self._tree_cache[image_file]
+
+    def extract_buffer_zone_data(self, coordinates_file, image_file, radius=None, img=None):
         radius = radius or self.default_radius
         try:
-            coords_df = pd.read_csv(coordinates_file)
+            coords_df = read_csv_fast(coordinates_file)
             required_cols = ['X', 'Y', 'Z']
             if any(c not in coords_df.columns for c in required_cols):
                 return pd.DataFrame()
             seeds = coords_df[required_cols].values
-            img = image.load_img(image_file)
-            X, A = self._apply_mask_and_get_affinity(seeds, img, radius, self.allow_overlap)
-            results = []
-            for i, seed in enumerate(seeds):
-                sphere_voxels = A[i].nonzero()[1]
-                if len(sphere_voxels) == 0:
-                    continue
-                if X is not None:
-                    sphere_values = X[:, sphere_voxels]
-                    mean_val, std_val = np.mean(sphere_values), np.std(sphere_values)
-                    max_val, min_val = np.max(sphere_values), np.min(sphere_values)
-                else:
-                    mean_val = std_val = max_val = min_val = np.nan
-                results.append({
-                    'seed_id': i, 'x': seed[0], 'y': seed[1], 'z': seed[2],
-                    'radius_mm': radius, 'voxel_count': len(sphere_voxels),
-                    'mean_value': mean_val, 'std_value': std_val, 'max_value': max_val, 'min_value': min_val
-                })
-            return pd.DataFrame(results)
+            X, tree = self._get_image_tree(image_file, img)
+            # Single-threaded: process_coordinate_files already runs one task per
+            # processing.n_jobs thread, and cKDTree releases the GIL while querying.
+            idx_lists = tree.query_ball_point(seeds, radius, workers=1, return_sorted=False)
+            indptr, indices = _ball_lists_to_csr(idx_lists)
+            rows, counts, mean_val, std_val, max_val, min_val = _sphere_stats(X, indptr, indices)
+            seed_xyz = seeds[rows].astype(np.float32)
+            return pd.DataFrame({
+                'seed_id': rows, 'x': seed_xyz[:, 0], 'y': seed_xyz[:, 1], 'z': seed_xyz[:, 2],
+                'radius_mm': np.float32(radius), 'voxel_count': counts,
+                'mean_value': mean_val, 'std_value': std_val, 'max_value': max_val, 'min_value': min_val
+            })
         except Exception as e:
             self.logger.error(f"Error extracting buffer zone: {e}")
             return pd.DataFrame()
@@ -105,16 +153,27 @@ class BufferZoneAnalyzer:
             return
         default_image = image_files[0]
         radius_options = self.bz_config.get('buffer_zone', {}).get('radius_options', [self.default_radius])
-        all_results = []
+        tasks = []
         for coord_file in coord_files:
-            subject_id = extract_subject_id(os.path.basename(coord_file), r'(\d{4})')
+            subject_id = extract_subject_id(os.path.basename(coord_file), self._subject_re)
             if subject_id is None:
                 continue
-            for radius in radius_options:
-                df = self.extract_buffer_zone_data(coord_file, default_image, radius)
-                if not df.empty:
-                    df['subject_id'] = subject_id
-                    all_results.append(df)
+            tasks.extend((coord_file, subject_id, radius) for radius in radius_options)
+        try:
+            img = image.load_img(default_image)
+            self._get_image_tree(default_image, img)
+        except Exception as e:
+            self.logger.error(f"Error preparing {default_image}: {e}")
+            return
+        # Threads share the cached image data and tree instead of pickling them to workers
+        results = Parallel(n_jobs=self.n_jobs, prefer='threads')(
+            delayed(self.extract_buffer_zone_data)(coord_file, default_image, radius, img)
+            for coord_file, _, radius in tasks)
+        all_results = []
+        for (_, subject_id, _), df in zip(tasks, results):
+            if not df.empty:
+                df['subject_id'] = subject_id
+                all_results.append(df)
         if all_results:
             pd.concat(all_results, ignore_index=True).to_csv(
                 os.path.join(self.output_dir, 'buffer_zone_metrics.csv'), index=False)
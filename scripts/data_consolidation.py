@@ -5,9 +5,82 @@ Data Consolidation Module - Combine covariate datasets.
 import os
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
+from joblib import Parallel, delayed
 
-from .utils import get_file_list, log_memory_usage
+from .utils import get_file_list, log_memory_usage, read_csv_fast
+
+# Voxel coordinate columns are parsed straight to int16
+COORD_DTYPES = {c: np.int16 for c in ('X', 'Y', 'Z', 'x', 'y', 'z')}
+COORD_KEYS = ['i', 'j', 'k']
+
+
+def _covariate_table(df, coord_cols, values, column_label):
+    """pyarrow table (i, j, k, column_label) from the coordinate columns of df and a value column."""
+    # Columns parsed as int16 come back as views, not copies; others are cast
+    i, j, k = (df[c].to_numpy(dtype=np.int16, copy=False) for c in coord_cols)
+    covariate_values = np.array(values, dtype=np.float32)
+    np.round(covariate_values, 3, out=covariate_values)
+    return pa.table({'i': i, 'j': j, 'k': k, column_label: covariate_values})
+
+
+def _strip_prefix(label, prefix=None):
+    return label[len(prefix):] if prefix and label.startswith(prefix) else label
+
+
+def _subject_label(subject, metadata, column_label, prefix_to_remove=None):
+    """Covariate label of one subject in a dataset-layout file."""
+    if b'label_prefix' not in metadata:
+        return f"{subject}_{column_label}"
+    prefix = metadata[b'label_prefix'].decode()
+    suffix = metadata.get(b'label_suffix', b'').decode()
+    return _strip_prefix(f"{prefix}{subject}{suffix}", prefix_to_remove)
+
+
+def _process_one_file(path, prefix_to_remove=None):
+    """
+    Read one covariate CSV or Parquet file into pyarrow tables with columns (i, j, k, <covariate>).
+
+    A file normally holds one covariate, in its last column. A file with
+    'subject' and 'Value' columns (the variable extraction "dataset" layout)
+    holds one covariate per subject. Each is labelled with the per-file output
+    name rebuilt from the label_prefix/label_suffix schema metadata, then
+    stripped of prefix_to_remove, so both layouts consolidate to the same
+    columns. Without that metadata the label is '<subject>_<file label>'.
+
+    Module-level so it can be dispatched to joblib workers. Returns a list of
+    tables, None when the file has no coordinate columns and the exception
+    instance on failure, leaving logging to the caller.
+    """
+    try:
+        metadata = {}
+        if path.endswith('.parquet'):
+            table = pq.read_table(path)
+            metadata = table.schema.metadata or {}
+            df = table.to_pandas()
+        else:
+            try:
+                df = read_csv_fast(path, dtype=COORD_DTYPES)
+            except ValueError:
+                # Float-formatted coordinates (e.g. "1.0") do not parse as int16;
+                # read untyped and truncate on the int16 cast.
+                df = read_csv_fast(path)
+        if 'X' in df.columns and 'Y' in df.columns and 'Z' in df.columns:
+            coord_cols = ['X', 'Y', 'Z']
+        elif 'x' in df.columns and 'y' in df.columns and 'z' in df.columns:
+            coord_cols = ['x', 'y', 'z']
+        else:
+            return None
+        column_label = _strip_prefix(os.path.splitext(os.path.basename(path))[0], prefix_to_remove)
+        if 'subject' in df.columns and 'Value' in df.columns:
+            return [_covariate_table(part, coord_cols, part['Value'],
+                                     _subject_label(subject, metadata, column_label, prefix_to_remove))
+                    for subject, part in df.groupby('subject', sort=False, observed=True)]
+        return [_covariate_table(df, coord_cols, df.iloc[:, -1], column_label)]
+    except Exception as e:
+        return e
 
 
 class DataConsolidator:
@@ -24,91 +97,120 @@ class DataConsolidator:
         self.remove_duplicates = c.get('remove_duplicates', True)
         self.handle_missing = c.get('handle_missing', 'drop')
         self.fill_value = c.get('fill_value', 0.0)
+        self.n_jobs = config.get('processing', {}).get('n_jobs', -1)
+        output_format = str(c.get('output_format', '.parquet')).lstrip('.').lower()
+        self.output_ext = '.csv' if output_format == 'csv' else '.parquet'
 
-    def consolidate_covariates(self, base_dir, output_file, prefix_to_remove=None):
-        if not os.path.isdir(base_dir):
-            return False
-        data_list = []
-        for subfolder in os.listdir(base_dir):
-            subfolder_path = os.path.join(base_dir, subfolder)
-            if not os.path.isdir(subfolder_path):
+    def _write_table(self, df, path):
+        if path.endswith('.parquet'):
+            df.to_parquet(path, engine='pyarrow', compression='zstd', index=False)
+        else:
+            df.to_csv(path, index=False)
+
+    def _read_table(self, path):
+        if path.endswith('.parquet'):
+            return pd.read_parquet(path, engine='pyarrow')
+        return read_csv_fast(path)
+
+    def _join_on_coordinates(self, tables):
+        """
+        Outer-join (source, table) pairs of single-covariate tables on (i, j, k).
+
+        When every table lists the same unique voxels in the same order (the usual
+        case for files extracted with one mask) the covariate columns are laid side
+        by side in Arrow and converted to pandas once, without a join.
+        """
+        keys = tables[0][1].select(COORD_KEYS)
+        if (all(t.num_rows == keys.num_rows and t.select(COORD_KEYS).equals(keys) for _, t in tables[1:])
+                and not keys.to_pandas().duplicated().any()):
+            columns = dict(zip(COORD_KEYS, keys.columns))
+            columns.update((t.column_names[-1], t.column(t.num_columns - 1)) for _, t in tables)
+            return pa.table(columns).to_pandas(split_blocks=True, self_destruct=True)
+        frames = []
+        for source, table in tables:
+            df = table.to_pandas().set_index(COORD_KEYS)
+            if not df.index.is_unique:
+                self.logger.warning(f"Duplicate voxel coordinates in {source}; keeping first occurrence")
+                df = df[~df.index.duplicated()]
+            frames.append(df)
+        return pd.concat(frames, axis=1, join='outer').reset_index()
+
+    def _list_covariate_files(self, base_dir):
+        """CSV/Parquet files in the subfolders of base_dir; raises FileNotFoundError if base_dir is missing."""
+        files = []
+        with os.scandir(base_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    files.extend(get_file_list(entry.path, ['.csv', '.parquet']))
+        return files
+
+    def _consolidate_files(self, work_list, output_file, prefix_to_remove=None):
+        results = Parallel(n_jobs=self.n_jobs, backend='loky', batch_size='auto')(
+            delayed(_process_one_file)(path, prefix_to_remove) for path in work_list)
+        tables = []
+        seen_labels = set()
+        for path, result in zip(work_list, results):
+            if isinstance(result, Exception):
+                self.logger.error(f"Error processing {path}: {result}")
                 continue
-            for csv_file in get_file_list(subfolder_path, ['.csv']):
-                try:
-                    df = pd.read_csv(csv_file)
-                    if 'X' in df.columns and 'Y' in df.columns and 'Z' in df.columns:
-                        coordinates = df[['X', 'Y', 'Z']].astype(np.int16)
-                        coord_cols = ['X', 'Y', 'Z']
-                    elif 'x' in df.columns and 'y' in df.columns and 'z' in df.columns:
-                        coordinates = df[['x', 'y', 'z']].astype(np.int16)
-                        coord_cols = ['x', 'y', 'z']
-                    else:
-                        continue
-                    covariate_values = df.iloc[:, -1].astype(np.float32).round(3)
-                    column_label = os.path.splitext(os.path.basename(csv_file))[0]
-                    if prefix_to_remove and column_label.startswith(prefix_to_remove):
-                        column_label = column_label[len(prefix_to_remove):]
-                    result_df = pd.DataFrame({
-                        'i': coordinates[coord_cols[0]],
-                        'j': coordinates[coord_cols[1]],
-                        'k': coordinates[coord_cols[2]],
-                        column_label: covariate_values
-                    })
-                    data_list.append(result_df)
-                except Exception as e:
-                    self.logger.error(f"Error processing {csv_file}: {e}")
-        if not data_list:
+            for table in result or ():
+                if table.column_names[-1] in seen_labels:
+                    continue
+                seen_labels.add(table.column_names[-1])
+                tables.append((path, table))
+        if not tables:
             return False
-        consolidated_df = pd.concat(data_list, axis=1)
-        consolidated_df = consolidated_df.loc[:, ~consolidated_df.columns.duplicated()]
-        consolidated_df.to_csv(output_file, index=False)
+        consolidated_df = self._join_on_coordinates(tables)
+        self._write_table(consolidated_df, output_file)
         return True
 
-    def consolidate_buffer_zone_data(self):
-        bz_dir = os.path.join(self.base_output_dir, 'buffer_zone')
-        if not os.path.exists(bz_dir):
-            bz_dir = os.path.join(self.input_dir, 'buffer_zone')
-        if not os.path.exists(bz_dir):
+    def _consolidate_first_existing(self, rel_dir, output_name, prefix_to_remove=None):
+        """Consolidate rel_dir from the output tree, falling back to the input tree."""
+        output_file = os.path.join(self.output_dir, output_name + self.output_ext)
+        for root in (self.base_output_dir, self.input_dir):
+            try:
+                files = self._list_covariate_files(os.path.join(root, rel_dir))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            return self._consolidate_files(files, output_file, prefix_to_remove)
+        return False
+
+    def consolidate_covariates(self, base_dir, output_file, prefix_to_remove=None):
+        try:
+            files = self._list_covariate_files(base_dir)
+        except (FileNotFoundError, NotADirectoryError):
             return False
-        return self.consolidate_covariates(bz_dir, os.path.join(self.output_dir, 'bz_consolidated_MFG_v1.csv'))
+        return self._consolidate_files(files, output_file, prefix_to_remove)
+
+    def consolidate_buffer_zone_data(self):
+        return self._consolidate_first_existing('buffer_zone', 'bz_consolidated_MFG_v1')
 
     def consolidate_edt_data(self):
-        edt_dir = os.path.join(self.base_output_dir, 'variables', 'edt')
-        if not os.path.exists(edt_dir):
-            edt_dir = os.path.join(self.input_dir, 'variables', 'edt')
-        if not os.path.exists(edt_dir):
-            return False
-        return self.consolidate_covariates(edt_dir, os.path.join(self.output_dir, 'edt_consolidated_MFG_v1.csv'), "v1_edt_")
+        return self._consolidate_first_existing(os.path.join('variables', 'edt'), 'edt_consolidated_MFG_v1', "v1_edt_")
 
     def consolidate_var_data(self):
-        var_dir = os.path.join(self.base_output_dir, 'variables', 'var')
-        if not os.path.exists(var_dir):
-            var_dir = os.path.join(self.input_dir, 'variables', 'var')
-        if not os.path.exists(var_dir):
-            return False
-        return self.consolidate_covariates(var_dir, os.path.join(self.output_dir, 'var_consolidated_MFG_v1.csv'))
+        return self._consolidate_first_existing(os.path.join('variables', 'var'), 'var_consolidated_MFG_v1')
 
     def consolidate_all_data(self):
-        bz_file = os.path.join(self.output_dir, 'bz_consolidated_MFG_v1.csv')
-        edt_file = os.path.join(self.output_dir, 'edt_consolidated_MFG_v1.csv')
-        var_file = os.path.join(self.output_dir, 'var_consolidated_MFG_v1.csv')
-        output_file = os.path.join(self.output_dir, 'Cov_all_consolidated_MFG_v1.csv')
-        existing = [(f, l) for (f, l) in [(bz_file, 'buffer_zone'), (edt_file, 'EDT'), (var_file, 'variance')] if os.path.exists(f)]
-        if not existing:
-            return False
+        bz_file = os.path.join(self.output_dir, 'bz_consolidated_MFG_v1' + self.output_ext)
+        edt_file = os.path.join(self.output_dir, 'edt_consolidated_MFG_v1' + self.output_ext)
+        var_file = os.path.join(self.output_dir, 'var_consolidated_MFG_v1' + self.output_ext)
+        output_file = os.path.join(self.output_dir, 'Cov_all_consolidated_MFG_v1' + self.output_ext)
         dataframes = []
-        for file_path, _ in existing:
+        for file_path in (bz_file, edt_file, var_file):
             try:
-                dataframes.append(pd.read_csv(file_path))
+                dataframes.append(self._read_table(file_path).set_index(COORD_KEYS))
+            except FileNotFoundError:
+                continue
             except Exception as e:
                 self.logger.error(f"Error loading {file_path}: {e}")
         if not dataframes:
             return False
-        merged_df = pd.concat(dataframes, axis=1)
-        merged_df = merged_df.loc[:, ~merged_df.columns.duplicated()]
+        merged_df = pd.concat(dataframes, axis=1, join='outer')
+        merged_df = merged_df.loc[:, ~merged_df.columns.duplicated()].reset_index()
         if self.handle_missing == 'fill':
             merged_df = merged_df.fillna(self.fill_value)
-        merged_df.to_csv(output_file, index=False)
+        self._write_table(merged_df, output_file)
         return True
 
     def run(self):
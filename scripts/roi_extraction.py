@@ -3,22 +3,38 @@ ROI Voxel Extraction Module
 """
 
 import os
-import glob
 import pandas as pd
 import numpy as np
 import nibabel as nib
-from nilearn import image, masking
 from nilearn.input_data import NiftiMasker
 import logging
 from pathlib import Path
 import re
+from joblib import Parallel, delayed
 
 from .utils import (
     get_file_list, extract_subject_id, validate_dataframe,
-    create_progress_logger, log_memory_usage
+    create_progress_logger, log_memory_usage, load_yaml_cached, read_csv_fast
 )
 
 
+def _masked_intensity(nifti_file, mask_bool, mask_affine):
+    """In-mask float32 intensities of one image; raises if it does not match the mask grid."""
+    img = nib.load(nifti_file)
+    if img.shape[:3] != mask_bool.shape or not np.allclose(img.affine, mask_affine):
+        raise ValueError("Image and mask differ in shape or affine")
+    # Index the stored data directly; no float64 get_fdata() copy of the volume
+    return np.asanyarray(img.dataobj, dtype=np.float32)[mask_bool]
+
+
+def _masked_intensity_or_error(nifti_file, mask_bool, mask_affine):
+    """joblib worker around _masked_intensity; returns the exception instead of raising."""
+    try:
+        return _masked_intensity(nifti_file, mask_bool, mask_affine)
+    except Exception as e:
+        return e
+
+
 class ROIExtractor:
     """Extract voxel coordinates and intensity values from ROIs."""
 
@@ -34,25 +50,31 @@ class ROIExtractor:
         self.coordinate_columns = self.roi_settings.get('coordinate_columns', ['X', 'Y', 'Z'])
         self.intensity_column = self.roi_settings.get('intensity_column', 'Intensity')
         self.subject_pattern = self.roi_settings.get('subject_id_pattern', r'(\d{4})')
+        self._subject_re = re.compile(self.subject_pattern)
+        self.n_jobs = config.get('processing', {}).get('n_jobs', -1)
+        self._mask_cache = {}
 
     def _load_roi_config(self):
         roi_config_path = os.path.join('config', 'roi_config.yaml')
         if os.path.exists(roi_config_path):
             try:
-                import yaml
-                with open(roi_config_path, 'r') as f:
-                    return yaml.safe_load(f)
+                return load_yaml_cached(roi_config_path)
             except Exception as e:
                 self.logger.warning(f"Could not load ROI config: {e}")
         return {}
 
+    def _load_mask(self, mask_file):
+        """Boolean mask, int32 in-mask voxel coordinates and affine of a mask file, cached per path."""
+        if mask_file not in self._mask_cache:
+            mask_img = nib.load(mask_file)
+            mask_bool = np.asanyarray(mask_img.dataobj) > 0
+            self._mask_cache[mask_file] = (mask_bool, np.argwhere(mask_bool).astype(np.int32), mask_img.affine)
+        return self._mask_cache[mask_file]
+
     def extract_coordinates_from_nifti(self, nifti_file, mask_file, subject_id):
         try:
-            img = image.load_img(nifti_file)
-            mask_img = image.load_img(mask_file)
-            masked_data = masking.apply_mask(img, mask_img, dtype='f')
-            mask_indices = np.where(mask_img.get_fdata() > 0)
-            coordinates = np.vstack(mask_indices).T
+            mask_bool, coordinates, mask_affine = self._load_mask(mask_file)
+            masked_data = _masked_intensity(nifti_file, mask_bool, mask_affine)
             df = pd.DataFrame(coordinates, columns=self.coordinate_columns)
             df[self.intensity_column] = masked_data
             df['sub.id'] = subject_id
@@ -63,7 +85,7 @@ class ROIExtractor:
 
     def extract_coordinates_from_csv(self, csv_file, subject_id):
         try:
-            df = pd.read_csv(csv_file)
+            df = read_csv_fast(csv_file)
             required_cols = self.coordinate_columns + [self.intensity_column]
             missing = [c for c in required_cols if c not in df.columns]
             if missing:
@@ -76,24 +98,35 @@ class ROIExtractor:
             return pd.DataFrame()
 
     def combine_coordinates_and_intensity(self, directory_path):
-        csv_files = glob.glob(f"{directory_path}/QNP_vox_coords/*.csv")
+        try:
+            with os.scandir(os.path.join(directory_path, 'QNP_vox_coords')) as entries:
+                csv_files = [e.path for e in entries
+                             if e.name.endswith('.csv') and not e.name.startswith('.') and e.is_file()]
+        except FileNotFoundError:
+            csv_files = []
         if not csv_files:
             return pd.DataFrame()
-        combined_df = pd.DataFrame(columns=self.coordinate_columns + [self.intensity_column, 'sub.id'])
+        output_columns = self.coordinate_columns + [self.intensity_column, 'sub.id']
+        frames = []
         for csv_file in csv_files:
             try:
-                df = pd.read_csv(csv_file)
-                subject_id = extract_subject_id(os.path.basename(csv_file), self.subject_pattern)
+                df = read_csv_fast(csv_file)
+                subject_id = extract_subject_id(os.path.basename(csv_file), self._subject_re)
                 if subject_id is None:
                     continue
                 df['sub.id'] = subject_id
                 if 'Intensity' in df.columns and self.intensity_column not in df.columns:
                     df.rename(columns={'Intensity': self.intensity_column}, inplace=True)
-                combined_df = pd.concat([combined_df, df], ignore_index=True)
+                frames.append(df)
             except Exception as e:
                 self.logger.error(f"Error processing {csv_file}: {e}")
+        if not frames:
+            return pd.DataFrame(columns=output_columns)
+        combined_df = pd.concat(frames, ignore_index=True)
+        combined_df = combined_df.reindex(
+            columns=output_columns + [c for c in combined_df.columns if c not in output_columns])
         if not combined_df.empty:
-            combined_df.drop_duplicates(subset=self.coordinate_columns + [self.intensity_column, 'sub.id'], inplace=True)
+            combined_df.drop_duplicates(subset=output_columns, inplace=True)
         return combined_df
 
     def process_nifti_files(self):
@@ -104,24 +137,41 @@ class ROIExtractor:
         if not mask_files:
             return
         default_mask = mask_files[0]
-        all_data = []
+        try:
+            mask_bool, coordinates, mask_affine = self._load_mask(default_mask)
+        except Exception as e:
+            self.logger.error(f"Error loading mask {default_mask}: {e}")
+            return
+        tasks = []
         for nifti_file in nifti_files:
-            subject_id = extract_subject_id(os.path.basename(nifti_file), self.subject_pattern)
-            if subject_id is None:
-                continue
-            df = self.extract_coordinates_from_nifti(nifti_file, default_mask, subject_id)
-            if not df.empty:
-                all_data.append(df)
-        if all_data:
-            combined_df = pd.concat(all_data, ignore_index=True)
-            combined_df.to_csv(os.path.join(self.output_dir, 'extracted_coordinates.csv'), index=False)
+            subject_id = extract_subject_id(os.path.basename(nifti_file), self._subject_re)
+            if subject_id is not None:
+                tasks.append((nifti_file, subject_id))
+        results = Parallel(n_jobs=self.n_jobs, backend='loky', batch_size='auto')(
+            delayed(_masked_intensity_or_error)(nifti_file, mask_bool, mask_affine) for nifti_file, _ in tasks)
+        intensities, subject_ids = [], []
+        for (nifti_file, subject_id), values in zip(tasks, results):
+            if isinstance(values, Exception):
+                self.logger.error(f"Error extracting from {nifti_file}: {values}")
+            elif len(values):
+                intensities.append(values)
+                subject_ids.append(subject_id)
+        if intensities:
+            # Every image shares the mask, so the rows are the mask coordinates
+            # repeated per subject: one frame built from whole columns instead
+            # of a frame per subject and a concat. pandas writes the CSV so
+            # string subject IDs stay unquoted.
+            columns = {col: np.tile(coordinates[:, i], len(intensities))
+                       for i, col in enumerate(self.coordinate_columns)}
+            columns[self.intensity_column] = np.concatenate(intensities)
+            columns['sub.id'] = np.repeat(subject_ids, len(coordinates))
+            pd.DataFrame(columns).to_csv(os.path.join(self.output_dir, 'extracted_coordinates.csv'), index=False)
 
     def process_csv_files(self):
-        qnp_dir = os.path.join(self.input_dir, 'QNP_vox_coords')
-        if os.path.exists(qnp_dir):
-            combined_df = self.combine_coordinates_and_intensity(self.input_dir)
-            if not combined_df.empty:
-                combined_df.to_csv(os.path.join(self.output_dir, 'combined_coordinates.csv'), index=False)
+        # A missing QNP_vox_coords directory simply yields no CSV files
+        combined_df = self.combine_coordinates_and_intensity(self.input_dir)
+        if not combined_df.empty:
+            combined_df.to_csv(os.path.join(self.output_dir, 'combined_coordinates.csv'), index=False)
 
     def run(self):
         self.logger.info("Starting ROI extraction...")
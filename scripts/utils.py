@@ -3,13 +3,27 @@ Utility functions for IBIS (Integrated Brain Information System).
 """
 
 import os
+import re
+import copy
+import functools
 import logging
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 from datetime import datetime
 
+# libyaml-backed loader when PyYAML was built with it
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+_DEFAULT_SUBJECT_RE = re.compile(r'(\d{4})')
+
+# Operand types whose division raises ZeroDivisionError on a zero denominator
+_PY_NUMBERS = (int, float)
+
 
 def setup_logging(log_dir, level='INFO', format_str=None, file_name='pipeline.log', console=True):
     """
@@ -68,43 +82,102 @@ def validate_config(config):
 
 def create_directories(directory_paths):
     """Create directories if they don't exist."""
-    for path in directory_paths:
-        os.makedirs(path, exist_ok=True)
+    paths = list(dict.fromkeys(directory_paths))
+    if len(paths) <= 1:
+        for path in paths:
+            os.makedirs(path, exist_ok=True)
+        return
+    # makedirs is idempotent and tolerates concurrent creation of shared parents,
+    # so the calls can overlap their filesystem latency (noticeable on NFS/Lustre).
+    with ThreadPoolExecutor(max_workers=min(8, len(paths))) as executor:
+        list(executor.map(lambda path: os.makedirs(path, exist_ok=True), paths))
 
 
 def load_yaml_config(config_path):
     """Load YAML configuration file."""
     try:
-        with open(config_path, 'r') as f:
-            return yaml.safe_load(f)
+        return load_yaml_cached(config_path)
     except Exception as e:
         raise ValueError(f"Error loading configuration file {config_path}: {e}")
 
 
+@functools.lru_cache(maxsize=32)
+def _load_yaml(path, mtime_ns):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=_YAML_LOADER)
+
+
+def load_yaml_cached(path):
+    """
+    Load a YAML file, reusing the parsed result while the file is unchanged.
+
+    Args:
+        path (str): Path to the YAML file
+
+    Returns:
+        Parsed YAML content (a fresh copy, safe to mutate)
+    """
+    path = os.path.abspath(path)
+    return copy.deepcopy(_load_yaml(path, os.stat(path).st_mtime_ns))
+
+
+def read_csv_fast(path, dtype=None):
+    """
+    Read a CSV into a DataFrame with the multithreaded pyarrow parser.
+
+    Args:
+        path (str): CSV file path
+        dtype (dict): Optional column name -> numpy dtype mapping, applied
+            while parsing; columns absent from the file are ignored
+
+    Returns:
+        pd.DataFrame: Parsed data
+    """
+    convert_options = None
+    if dtype:
+        convert_options = pa_csv.ConvertOptions(
+            column_types={col: pa.from_numpy_dtype(np.dtype(t)) for col, t in dtype.items()})
+    return pa_csv.read_csv(path, convert_options=convert_options).to_pandas()
+
+
+def write_csv_fast(path, columns):
+    """
+    Write equal-length 1-D arrays to CSV without building a DataFrame.
+
+    Uses the pyarrow CSV writer.
+
+    Args:
+        path (str): Output CSV path
+        columns (dict): Column name -> 1-D array, in output order
+    """
+    with open(path, 'wb') as f:
+        f.write((','.join(columns) + '\n').encode())
+        pa_csv.write_csv(pa.table(columns), f, write_options=pa_csv.WriteOptions(include_header=False))
+
+
 def get_file_list(directory, file_patterns=None):
     """Get list of files from directory matching patterns."""
-    if not os.path.exists(directory):
+    suffixes = None if file_patterns is None else tuple(file_patterns)
+    try:
+        with os.scandir(directory) as entries:
+            return sorted(entry.path for entry in entries
+                          if entry.is_file() and (suffixes is None or entry.name.endswith(suffixes)))
+    except FileNotFoundError:
         return []
-    files = []
-    for file in os.listdir(directory):
-        file_path = os.path.join(directory, file)
-        if os.path.isfile(file_path):
-            if file_patterns is None:
-                files.append(file_path)
-            else:
-                for pattern in file_patterns:
-                    if file.endswith(pattern):
-                        files.append(file_path)
-                        break
-    return sorted(files)
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_subject_pattern(pattern):
+    return re.compile(pattern)
 
 
 def extract_subject_id(filename, pattern=None):
-    """Extract subject ID from filename."""
-    import re
+    """Extract subject ID from filename; pattern may be a regex string or a compiled re.Pattern."""
     if pattern is None:
-        pattern = r'(\d{4})'
-    match = re.search(pattern, filename)
+        pattern = _DEFAULT_SUBJECT_RE
+    elif isinstance(pattern, str):
+        pattern = _compile_subject_pattern(pattern)
+    match = pattern.search(filename)
     return match.group(1) if match else None
 
 
@@ -112,29 +185,28 @@ def validate_dataframe(df, required_columns=None, min_rows=1):
     """Validate DataFrame structure and content."""
     if df is None or df.empty or len(df) < min_rows:
         return False
-    if required_columns:
-        missing = [col for col in required_columns if col not in df.columns]
-        if missing:
-            return False
-    return True
+    return not required_columns or not set(required_columns).difference(df.columns)
 
 
 def safe_divide(numerator, denominator, default=0.0):
     """Safely divide two numbers."""
     try:
-        return default if denominator == 0 else numerator / denominator
-    except (TypeError, ValueError):
+        if type(numerator) in _PY_NUMBERS and type(denominator) in _PY_NUMBERS:
+            return numerator / denominator
+        # NumPy operands return inf/nan with a warning instead of raising
+        with np.errstate(divide='raise', invalid='raise'):
+            return numerator / denominator
+    except (ZeroDivisionError, FloatingPointError, TypeError, ValueError):
         return default
 
 
 def create_progress_logger(logger, total_items, description="Processing"):
     """Create a progress logger for tracking processing steps."""
     def log_progress(current_item, item_name=None):
-        progress = (current_item / total_items) * 100
-        msg = f"{description}: {current_item}/{total_items} ({progress:.1f}%)"
-        if item_name:
-            msg += f" - {item_name}"
-        logger.info(msg)
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        logger.info("%s: %d/%d (%.1f%%)%s", description, current_item, total_items,
+                    current_item * 100.0 / total_items, f" - {item_name}" if item_name else "")
     return log_progress
 
 
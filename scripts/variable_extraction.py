@@ -4,14 +4,81 @@ Variable Extraction Module - EDT and Variance from masked regions.
 
 import os
 import numpy as np
-import pandas as pd
-import nilearn
-from nilearn import image
-from nilearn.masking import apply_mask
+import nibabel as nib
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
 import gc
+from collections import namedtuple
+from joblib import Parallel, delayed
 
-from .utils import get_file_list, create_progress_logger, log_memory_usage
+from .utils import get_file_list, create_progress_logger, log_memory_usage, write_csv_fast
+
+
+# What extraction workers need of a mask: volume shape, affine, the bounding-box
+# slices of the mask, and the mask cropped to that box as np.packbits output, so
+# each task pickles one bit per box voxel.
+_MaskIndex = namedtuple('_MaskIndex', ['shape', 'affine', 'bbox', 'packed'])
+
+
+# Value column dtypes accepted for variable_extraction.output_dtype
+_OUTPUT_DTYPES = (np.dtype(np.float32), np.dtype(np.float16), np.dtype(np.int16))
+
+
+def _coordinate_columns(coordinates):
+    """Split an (n, 3) voxel index array into contiguous int16 X/Y/Z output columns."""
+    return {axis: coordinates[:, i].astype(np.int16) for i, axis in enumerate(('X', 'Y', 'Z'))}
+
+
+def _masked_values(img, mask):
+    """In-mask voxel values of img as float32, reading only the mask's bounding box."""
+    if img.shape[:3] != mask.shape or not np.allclose(img.affine, mask.affine):
+        raise ValueError(f"{img.get_filename()} and mask differ in shape or affine")
+    box_shape = tuple(s.stop - s.start for s in mask.bbox)
+    local_bool = np.unpackbits(mask.packed, count=int(np.prod(box_shape))).reshape(box_shape).view(bool)
+    # Slicing the proxy reads just the bounding box from disk instead of the volume.
+    data = np.asanyarray(img.dataobj[mask.bbox])
+    return data[local_bool].astype(np.float32, copy=False)
+
+
+def _write_values(path_stem, coord_columns, values, output_ext):
+    """Write one X/Y/Z/Value table to path_stem plus output_ext."""
+    columns = {**coord_columns, 'Value': values}
+    if output_ext == '.parquet':
+        pq.write_table(pa.table(columns), path_stem + '.parquet', compression='zstd')
+    else:
+        write_csv_fast(path_stem + '.csv', columns)
+
+
+def _extract_values(image_file, mask, output_dtype):
+    """In-mask values of image_file cast to output_dtype."""
+    values = _masked_values(nib.load(image_file), mask)
+    if output_dtype.kind == 'i':
+        # Round rather than truncate, e.g. EDT values stored as whole voxel distances
+        np.rint(values, out=values)
+        info = np.iinfo(output_dtype)
+        # NaN fails both comparisons, so it is rejected along with out-of-range values
+        if not ((values >= info.min) & (values <= info.max)).all():
+            raise ValueError(f"values outside the {output_dtype} range [{info.min}, {info.max}] "
+                             f"or not finite; use a float output_dtype")
+    return values.astype(output_dtype, copy=False)
+
+
+def _process_one(image_file, path_stem, mask, coord_columns, output_ext, output_dtype=np.float32):
+    """Extract one image's in-mask values to its own table; returns the exception on failure."""
+    try:
+        _write_values(path_stem, coord_columns, _extract_values(image_file, mask, output_dtype), output_ext)
+    except Exception as e:
+        return e
+    return None
+
+
+def _collect_one(image_file, mask, output_dtype=np.float32):
+    """In-mask values of one image for the dataset layout; returns the exception on failure."""
+    try:
+        return _extract_values(image_file, mask, output_dtype)
+    except Exception as e:
+        return e
 
 
 class VariableExtractor:
@@ -23,33 +90,105 @@ class VariableExtractor:
         self.input_dir = config['paths']['input_dir']
         self.output_dir = os.path.join(config['paths']['output_dir'], 'variables')
         self.mask_dir = os.path.join(self.input_dir, 'masks')
-        os.makedirs(self.output_dir, exist_ok=True)
-        os.makedirs(os.path.join(self.output_dir, 'edt'), exist_ok=True)
-        os.makedirs(os.path.join(self.output_dir, 'var'), exist_ok=True)
+        self._edt_outdir = os.path.join(self.output_dir, 'edt')
+        self._var_outdir = os.path.join(self.output_dir, 'var')
+        os.makedirs(self._edt_outdir, exist_ok=True)
+        os.makedirs(self._var_outdir, exist_ok=True)
         var_settings = config.get('variable_extraction', {})
         self.edt_enabled = var_settings.get('edt', {}).get('enabled', True)
         self.var_enabled = var_settings.get('var', {}).get('enabled', True)
+        output_format = str(var_settings.get('output_format', '.parquet')).lstrip('.').lower()
+        self.output_ext = '.csv' if output_format == 'csv' else '.parquet'
+        self.output_layout = str(var_settings.get('output_layout', 'files')).lower()
+        if self.output_layout not in ('files', 'dataset'):
+            raise ValueError(f"variable_extraction.output_layout must be 'files' or 'dataset', "
+                             f"got {self.output_layout!r}")
+        self.output_dtype = np.dtype(var_settings.get('output_dtype', 'float32'))
+        if self.output_dtype not in _OUTPUT_DTYPES:
+            raise ValueError(f"variable_extraction.output_dtype must be one of "
+                             f"{', '.join(str(d) for d in _OUTPUT_DTYPES)}, got {self.output_dtype}")
+        if self.output_dtype == np.float16:
+            # The dataset layout is always Parquet
+            if self.output_layout == 'files' and self.output_ext == '.csv':
+                # CSV prints the exact decimal expansion of each half-float, which is
+                # longer than float32 text and adds digits the value does not carry
+                raise ValueError("variable_extraction.output_dtype float16 requires Parquet output; "
+                                 "use float32 with output_format '.csv'")
+            if int(pa.__version__.split('.')[0]) < 15:
+                # Parquet half-float columns need pyarrow 15
+                raise ValueError(f"variable_extraction.output_dtype float16 requires pyarrow>=15, "
+                                 f"found {pa.__version__}")
+        self.n_jobs = config.get('processing', {}).get('n_jobs', -1)
+        self._mask_cache = {}
+
+    def _load_mask(self, mask_path):
+        """_MaskIndex and int32 in-mask voxel coordinates of a mask file, cached per path."""
+        if mask_path not in self._mask_cache:
+            mask_img = nib.load(mask_path)
+            mask_bool = np.asanyarray(mask_img.dataobj) > 0
+            coordinates = np.argwhere(mask_bool).astype(np.int32)
+            if len(coordinates):
+                lo, hi = coordinates.min(axis=0), coordinates.max(axis=0) + 1
+            else:
+                lo = hi = np.zeros(3, dtype=np.int32)
+            bbox = tuple(slice(int(l), int(h)) for l, h in zip(lo, hi))
+            mask = _MaskIndex(mask_bool.shape, mask_img.affine, bbox, np.packbits(mask_bool[bbox]))
+            self._mask_cache[mask_path] = (mask, coordinates)
+        return self._mask_cache[mask_path]
+
+    def _extract_files(self, image_files, names, out_dir, prefix, roi_name, mask, coord_columns, label):
+        """Extract image_files in parallel in the configured layout; True when every file succeeded."""
+        if self.output_layout == 'dataset':
+            return self._extract_dataset(image_files, names, out_dir, prefix, roi_name, mask, coord_columns, label)
+        results = Parallel(n_jobs=self.n_jobs, backend='loky', batch_size='auto')(
+            delayed(_process_one)(image_file, os.path.join(out_dir, f"{prefix}{name}_{roi_name}"),
+                                  mask, coord_columns, self.output_ext, self.output_dtype)
+            for image_file, name in zip(image_files, names))
+        failed = [(f, e) for f, e in zip(image_files, results) if e is not None]
+        for image_file, e in failed:
+            self.logger.error(f"{label} extraction failed for {image_file}: {e}")
+        return not failed
+
+    def _extract_dataset(self, image_files, names, out_dir, prefix, roi_name, mask, coord_columns, label):
+        """
+        Write all extractions to one tall Parquet file, <prefix><roi_name>.parquet, with a 'subject' column.
+
+        Each image becomes one row group, written as worker results arrive, so
+        readers can filter on subject using row-group statistics and the parent
+        holds one image's values at a time. The schema metadata records the
+        prefix and suffix around the subject in per-file output names, so
+        consolidation labels each subject as the files layout would.
+        """
+        subject_type = pa.dictionary(pa.int32(), pa.string())
+        schema = pa.schema([(axis, pa.int16()) for axis in coord_columns]
+                           + [('Value', pa.from_numpy_dtype(self.output_dtype)), ('subject', subject_type)],
+                           metadata={'label_prefix': prefix, 'label_suffix': f"_{roi_name}"})
+        output_file = os.path.join(out_dir, f"{prefix}{roi_name}.parquet")
+        results = Parallel(n_jobs=self.n_jobs, backend='loky', batch_size='auto', return_as='generator')(
+            delayed(_collect_one)(image_file, mask, self.output_dtype) for image_file in image_files)
+        failed = False
+        with pq.ParquetWriter(output_file, schema, compression='zstd') as writer:
+            for image_file, name, values in zip(image_files, names, results):
+                if isinstance(values, Exception):
+                    self.logger.error(f"{label} extraction failed for {image_file}: {values}")
+                    failed = True
+                    continue
+                subject = pa.DictionaryArray.from_arrays(np.zeros(len(values), dtype=np.int32), pa.array([name]))
+                writer.write_table(pa.table({**coord_columns, 'Value': values, 'subject': subject}, schema=schema))
+        return not failed
 
     def extract_edt_values(self, edt_dir, mask_path, roi_name):
         if not self.edt_enabled:
             return True
         try:
-            mask_img = nilearn.image.load_img(mask_path)
             edt_files = get_file_list(edt_dir, ['_masked.nii.gz'])
             if not edt_files:
                 return False
-            for edt_file in edt_files:
-                name = os.path.basename(edt_file).split('_masked.nii.gz')[0]
-                img = nilearn.image.load_img(edt_file)
-                masked_data = apply_mask(img, mask_img, dtype='f')
-                mask_indices = np.where(mask_img.get_fdata() > 0)
-                coordinates = np.vstack(mask_indices).T
-                df = pd.DataFrame(coordinates, columns=['X', 'Y', 'Z'])
-                df['Value'] = masked_data
-                df.to_csv(os.path.join(self.output_dir, 'edt', f"v1_edt_{name}_{roi_name}.csv"), index=False)
-                del img, masked_data, df
-                gc.collect()
-            return True
+            mask, coordinates = self._load_mask(mask_path)
+            coord_columns = _coordinate_columns(coordinates)
+            names = [os.path.basename(f).split('_masked.nii.gz')[0] for f in edt_files]
+            return self._extract_files(edt_files, names, self._edt_outdir, "v1_edt_", roi_name,
+                                       mask, coord_columns, "EDT")
         except Exception as e:
             self.logger.error(f"EDT extraction failed: {e}")
             return False
@@ -62,19 +201,11 @@ class VariableExtractor:
             mask_files = get_file_list(mask_dir, ['.nii.gz', '.nii'])
             if not var_files or not mask_files:
                 return False
-            mask_img = nilearn.image.load_img(mask_files[0])
-            for var_file in var_files:
-                name = os.path.basename(var_file).split('.nii')[0]
-                img = nilearn.image.load_img(var_file)
-                masked_data = apply_mask(img, mask_img, dtype='f')
-                mask_indices = np.where(mask_img.get_fdata() > 0)
-                coordinates = np.vstack(mask_indices).T
-                df = pd.DataFrame(coordinates, columns=['X', 'Y', 'Z'])
-                df['Value'] = masked_data
-                df.to_csv(os.path.join(self.output_dir, 'var', f"var_{name}_{roi_name}.csv"), index=False)
-                del img, masked_data, df
-                gc.collect()
-            return True
+            mask, coordinates = self._load_mask(mask_files[0])
+            coord_columns = _coordinate_columns(coordinates)
+            names = [os.path.basename(f).split('.nii')[0] for f in var_files]
+            return self._extract_files(var_files, names, self._var_outdir, "var_", roi_name,
+                                       mask, coord_columns, "Variance")
         except Exception as e:
             self.logger.error(f"Variance extraction failed: {e}")
             return False
@@ -109,6 +240,7 @@ class VariableExtractor:
             if self.var_enabled:
                 self.process_var_directory()
             log_memory_usage(self.logger, "Final")
+            gc.collect()
         except Exception as e:
             self.logger.error(f"Variable extraction failed: {e}")
             raise
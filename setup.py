@@ -21,10 +21,10 @@ setup(
         "pandas>=1.3.0",
         "nibabel>=3.2.0",
         "nilearn>=0.9.0",
-        "scikit-learn>=1.0.0",
         "scipy>=1.7.0",
-        "joblib>=1.1.0",
+        "joblib>=1.3.0",
         "PyYAML>=6.0",
+        "pyarrow>=7.0.0",
         "matplotlib>=3.5.0",
         "seaborn>=0.11.0",
         "tqdm>=4.62.0",
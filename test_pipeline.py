@@ -14,8 +14,13 @@ def test_utils():
     assert validate_dataframe(None) is False
     import pandas as pd
     assert validate_dataframe(pd.DataFrame({'A': [1], 'B': [2]}), required_columns=['A', 'B']) is True
+    assert validate_dataframe(pd.DataFrame({'A': [1]}), required_columns=['A', 'B']) is False
     assert safe_divide(10, 2) == 5.0 and safe_divide(10, 0, 0.0) == 0.0
+    import numpy as np
+    assert safe_divide(1.0, np.float64(0)) == 0.0 and safe_divide(np.float32(0), 0, -1.0) == -1.0
     assert extract_subject_id("6966_coords.csv") == "6966"
+    import re
+    assert extract_subject_id("sub_6966.nii.gz", re.compile(r'sub_(\d+)')) == "6966"
     print("Utils OK")
 
 def test_config_validation():
@@ -34,12 +39,116 @@ def test_imports():
     from scripts.data_consolidation import DataConsolidator
     print("Imports OK")
 
+def test_lazy_imports():
+    import subprocess
+    code = ("import sys, scripts, run_ibis_pipeline; "
+            "assert 'nilearn' not in sys.modules and 'nibabel' not in sys.modules; "
+            "scripts.DataConsolidator")
+    subprocess.run([sys.executable, "-c", code], cwd=_ROOT, check=True)
+    print("Lazy imports OK")
+
+def test_sphere_stats():
+    import numpy as np
+    from scripts import _bz_kernels
+    from scripts.buffer_zone import _ball_lists_to_csr, _sphere_stats
+    X = np.array([[1.0, 2.0, 3.0, 4.0]], dtype=np.float32)
+    indptr, indices = _ball_lists_to_csr([[1, 0], [], [1, 2, 3]])
+    assert indptr.tolist() == [0, 2, 2, 5]
+    kernel = _bz_kernels.sphere_stats
+    try:
+        # Numba kernel (when installed) and NumPy fallback must agree
+        for impl in (kernel, None):
+            _bz_kernels.sphere_stats = impl
+            rows, counts, mean, std, max_val, min_val = _sphere_stats(X, indptr, indices)
+            assert rows.tolist() == [0, 2] and counts.tolist() == [2, 3]
+            assert np.allclose(mean, [1.5, 3.0]) and np.allclose(std, [0.5, np.std([2, 3, 4])])
+            assert max_val.tolist() == [2.0, 4.0] and min_val.tolist() == [1.0, 2.0]
+    finally:
+        _bz_kernels.sphere_stats = kernel
+    print("Sphere stats OK")
+
+def test_consolidation_alignment():
+    import tempfile
+    import pandas as pd
+    from scripts.data_consolidation import DataConsolidator
+    with tempfile.TemporaryDirectory() as tmp:
+        voxels = [(1, 2, 3), (4, 5, 6), (7, 8, 9)]
+        # Same voxels; 'b' lists them in a different row order than 'a' and 'c'
+        tables = {'a': (voxels, [1.0, 2.0, 3.0]), 'b': (voxels[::-1], [30.0, 20.0, 10.0]),
+                  'c': (voxels, [100.0, 200.0, 300.0])}
+        for name, (rows, values) in tables.items():
+            os.makedirs(os.path.join(tmp, 'cov', name))
+            coords = pd.DataFrame(rows, columns=['X', 'Y', 'Z'])
+            if name == 'c':
+                coords = coords.astype(float)  # written as "1.0", like buffer_zone_metrics.csv
+            coords.assign(Value=values).to_csv(
+                os.path.join(tmp, 'cov', name, f'{name}.csv'), index=False)
+        config = {'paths': {'input_dir': tmp, 'output_dir': tmp}, 'processing': {'n_jobs': 1},
+                  'consolidation': {'output_format': '.csv'}}
+        out = os.path.join(tmp, 'cov.csv')
+        assert DataConsolidator(config).consolidate_covariates(os.path.join(tmp, 'cov'), out)
+        df = pd.read_csv(out).set_index(['i', 'j', 'k']).sort_index()
+        assert df.loc[(1, 2, 3), ['a', 'b', 'c']].tolist() == [1.0, 10.0, 100.0]
+        assert df.loc[(7, 8, 9), ['a', 'b', 'c']].tolist() == [3.0, 30.0, 300.0]
+        assert len(df) == 3
+    print("Consolidation alignment OK")
+
+def test_dataset_layout_consolidation():
+    import shutil
+    import tempfile
+    import numpy as np
+    import nibabel as nib
+    import pandas as pd
+    from scripts.variable_extraction import VariableExtractor
+    from scripts.data_consolidation import DataConsolidator
+    with tempfile.TemporaryDirectory() as tmp:
+        for sub in ('masks', 'edt', 'var'):
+            os.makedirs(os.path.join(tmp, 'in', sub))
+        mask = np.zeros((4, 5, 6), dtype=np.uint8)
+        mask[1:3, 2:4, 3] = 1
+        mask_file = os.path.join(tmp, 'in', 'masks', 'MFG_mask.nii.gz')
+        nib.save(nib.Nifti1Image(mask, np.eye(4)), mask_file)
+        volumes = {}
+        for kind, suffix in (('edt', '_masked.nii.gz'), ('var', '.nii.gz')):
+            for subject in ('1001', '1002'):
+                volumes[kind, subject] = np.random.default_rng(int(subject)).random(mask.shape).astype(np.float32)
+                nib.save(nib.Nifti1Image(volumes[kind, subject], np.eye(4)),
+                         os.path.join(tmp, 'in', kind, f'{subject}{suffix}'))
+        # Prefixes stripped by consolidate_edt_data / consolidate_var_data
+        prefixes = {'edt': 'v1_edt_', 'var': None}
+        expected_columns = {'edt': ['1001_MFG', '1002_MFG'], 'var': ['var_1001_MFG', 'var_1002_MFG']}
+        for layout in ('files', 'dataset'):
+            out_dir = os.path.join(tmp, layout)
+            config = {'paths': {'input_dir': os.path.join(tmp, 'in'), 'output_dir': out_dir},
+                      'processing': {'n_jobs': 1}, 'variable_extraction': {'output_layout': layout},
+                      'consolidation': {'output_format': '.csv'}}
+            extractor = VariableExtractor(config)
+            assert extractor.extract_edt_values(os.path.join(tmp, 'in', 'edt'), mask_file, 'MFG')
+            assert extractor.extract_var_values(os.path.join(tmp, 'in', 'var'), os.path.join(tmp, 'in', 'masks'), 'MFG')
+            for kind, extracted_dir in (('edt', extractor._edt_outdir), ('var', extractor._var_outdir)):
+                # Consolidation reads covariate files from subfolders
+                cov_dir = os.path.join(out_dir, 'cov_' + kind)
+                shutil.copytree(extracted_dir, os.path.join(cov_dir, 'all'))
+                out = os.path.join(out_dir, kind + '.csv')
+                assert DataConsolidator(config).consolidate_covariates(cov_dir, out, prefixes[kind])
+                df = pd.read_csv(out).set_index(['i', 'j', 'k']).sort_index()
+                # Both layouts consolidate to the same column names
+                assert sorted(df.columns) == expected_columns[kind], (layout, kind, list(df.columns))
+                for subject, column in zip(('1001', '1002'), expected_columns[kind]):
+                    expected = np.round(volumes[kind, subject][mask > 0], 3)
+                    assert np.allclose(df[column].to_numpy(), expected, atol=1e-3)
+    print("Dataset layout consolidation OK")
+
 def main():
     print("IBIS (Integrated Brain Information System) tests")
     print("-" * 40)
     test_utils()
     test_config_validation()
     test_imports()
+    test_lazy_imports()
+    test_sphere_stats()
+    test_consolidation_alignment()
+    test_dataset_layout_consolidation()
     print("-" * 40)
     print("All checks passed.")
     return 0